@@ -1,17 +1,26 @@
+from functools import lru_cache
+
 from dotenv import load_dotenv
-from pydantic import BaseModel
-import os
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
-# Carga el .env automáticamente
+# Carga el .env automáticamente (también para los módulos que leen
+# os.getenv directamente: OPENAI_API_KEY, TESSERACT_CMD, FRONTEND_URL, ...)
 load_dotenv()
 
 
-class Settings(BaseModel):
-    environment: str = os.getenv("ENVIRONMENT", "development")
-    database_url: str = os.getenv("DATABASE_URL")
-    jwt_secret: str = os.getenv("JWT_SECRET")
-    jwt_algorithm: str = os.getenv("JWT_ALGORITHM")
+class Settings(BaseSettings):
+    environment: str = "development"
+    database_url: str
+    jwt_secret: str
+    jwt_algorithm: str = "HS256"
+
+    model_config = SettingsConfigDict(env_file=".env", frozen=True)
+
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
 
 
 # Instancia global de settings
-settings = Settings()
+settings = get_settings()
@@ -1,5 +1,7 @@
+import base64
+import json
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from jose import JWTError, jwt
 
@@ -18,6 +20,21 @@ def create_access_token(data: Dict[str, Any]) -> str:
     return encoded_jwt
 
 
+def peek_exp(token: str) -> Optional[int]:
+    """Read the exp claim from the payload segment WITHOUT verifying the
+    signature. Only safe for short-circuiting obviously-expired tokens before
+    paying for the full HMAC verify; never trust any other claim from here.
+    Returns None if the token is malformed or has no exp."""
+    try:
+        payload_b64 = token.split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload_b64))
+        exp = claims.get("exp")
+        return int(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
 def decode_access_token(token: str) -> Dict[str, Any]:
     try:
         payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
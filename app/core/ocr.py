@@ -0,0 +1,44 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Pool propio y acotado para OCR: tesseract mastica CPU durante segundos y
+# el threadpool genérico de starlette (40 hilos) dejaría que un burst de
+# recibos corra todo a la vez, pisándose entre sí y con el resto de la app.
+# OCR_CONCURRENCY limita cuántos OCR corren en paralelo; el semáforo hace
+# que el resto espere en el event loop sin ocupar un hilo.
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", str(min(os.cpu_count() or 4, 4))))
+
+_ocr_pool: Optional[ThreadPoolExecutor] = None
+_ocr_sem: Optional[asyncio.Semaphore] = None
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+    return _ocr_pool
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Perezoso para que quede atado al event loop que realmente lo usa
+    global _ocr_sem
+    if _ocr_sem is None:
+        _ocr_sem = asyncio.Semaphore(OCR_CONCURRENCY)
+    return _ocr_sem
+
+
+async def run_ocr(func: Callable[..., T], *args) -> T:
+    """Ejecuta `func(*args)` (CPU-bound) en el pool acotado de OCR."""
+    async with _get_semaphore():
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), func, *args)
+
+
+def shutdown_ocr_pool() -> None:
+    global _ocr_pool
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown(wait=False)
+        _ocr_pool = None
@@ -1,49 +1,234 @@
+import asyncio
 import hashlib
+import hmac
 import os
-from typing import Tuple
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
 import uuid
 
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlmodel import Session, select
+from sqlmodel import Session
 from jose.exceptions import ExpiredSignatureError, JWTError
 
 from ..database import get_session
 from ..models.user import User
-from .jwt import decode_access_token
+from .jwt import decode_access_token, peek_exp
 
 
 ALGORITHM = "pbkdf2_sha256"
 ITERATIONS = 100_000
 SALT_BYTES = 16
 
+# Prefer the C implementation (OpenSSL EVP loop with SHA-NI acceleration) when
+# available; same signature and output as hashlib, so stored hashes keep working.
+try:
+    from fastpbkdf2 import pbkdf2_hmac as _pbkdf2_hmac
+except ImportError:
+    _pbkdf2_hmac = hashlib.pbkdf2_hmac
+
+# argon2id is ~3-5x cheaper per verify than 100k-iteration PBKDF2 at equivalent
+# brute-force resistance. New hashes use argon2 when the lib is installed; old
+# pbkdf2_sha256$... envelopes keep verifying and are rehashed on login.
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import Argon2Error, InvalidHashError
+
+    _argon2 = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+except ImportError:
+    _argon2 = None
+
 
 def _pbkdf2_hash(password: str, salt: bytes) -> bytes:
-    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, ITERATIONS)
+    return _pbkdf2_hmac("sha256", password.encode("utf-8"), salt, ITERATIONS)
+
+
+# Salts are sliced from a pre-filled CSPRNG buffer so registration bursts pay
+# one getrandom(2) syscall per 4 KB instead of one per salt. Slices are
+# consumed destructively, so no two callers can ever receive the same bytes.
+_SALT_POOL = bytearray()
+_SALT_POOL_REFILL = 4096
+_SALT_LOCK = threading.Lock()
+
+
+def _salt(n: int = SALT_BYTES) -> bytes:
+    with _SALT_LOCK:
+        if len(_SALT_POOL) < n:
+            _SALT_POOL.extend(os.urandom(_SALT_POOL_REFILL))
+        out = bytes(_SALT_POOL[:n])
+        del _SALT_POOL[:n]
+    return out
 
 
 def hash_password(password: str) -> str:
-    salt = os.urandom(SALT_BYTES)
+    if _argon2 is not None:
+        return _argon2.hash(password)
+    salt = _salt()
     digest = _pbkdf2_hash(password, salt)
     return f"{ALGORITHM}${salt.hex()}${digest.hex()}"
 
 
-def verify_password(password: str, stored: str) -> bool:
+def _verify_pbkdf2(password: str, stored: str) -> bool:
     try:
-        stored = stored.strip()
         algorithm, salt_hex, hash_hex = stored.split("$")
         if algorithm != ALGORITHM:
             return False
         salt = bytes.fromhex(salt_hex)
         expected = bytes.fromhex(hash_hex)
         candidate = _pbkdf2_hash(password, salt)
-        return candidate == expected
+        # Branchless compare: no timing side-channel and stable latency
+        return hmac.compare_digest(candidate, expected)
+    except Exception:
+        return False
+
+
+def verify_password(password: str, stored: str) -> bool:
+    stored = (stored or "").strip()
+    if stored.startswith(f"{ALGORITHM}$"):
+        return _verify_pbkdf2(password, stored)
+    if _argon2 is not None:
+        try:
+            return _argon2.verify(stored, password)
+        except (Argon2Error, InvalidHashError):
+            return False
+        except Exception:
+            return False
+    return False
+
+
+# KDF work is CPU-bound and pins a worker thread for the whole derive; running
+# it in a process pool escapes the GIL so login throughput scales with cores.
+_hash_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    global _hash_pool
+    if _hash_pool is None:
+        _hash_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _hash_pool
+
+
+def shutdown_hash_pool() -> None:
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False)
+        _hash_pool = None
+
+
+async def a_hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hash_pool(), hash_password, password)
+
+
+async def a_verify_password(password: str, stored: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_hash_pool(), verify_password, password, stored)
+
+
+def password_needs_rehash(stored: str) -> bool:
+    """True when a successfully-verified password should be re-hashed (e.g. a
+    legacy pbkdf2 envelope, or argon2 parameters that have since changed)."""
+    if _argon2 is None:
+        return False
+    stored = (stored or "").strip()
+    if stored.startswith(f"{ALGORITHM}$"):
+        return True
+    try:
+        return _argon2.check_needs_rehash(stored)
     except Exception:
         return False
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token", auto_error=False)
 
+# Canonical 8-4-4-4-12 UUID shape; lets us reject malformed token subjects
+# without paying for uuid.UUID's parse-and-raise on garbage input.
+_UUID_RE = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$",
+    re.IGNORECASE,
+)
+
+
+# Cache of already-verified tokens so repeat requests skip the HMAC verify and
+# JSON decode in jose. We run a single process per instance, so an in-process
+# dict keyed by a short token digest is enough (no shared Redis in this stack).
+# Entries expire with the token itself and are dropped on logout.
+_TOKEN_CACHE: Dict[str, Tuple[str, float]] = {}
+_TOKEN_CACHE_MAX = 10_000
+# get_current_user corre en workers del threadpool: el barrido de expirados
+# itera el dict y un insert concurrente lo rompería a mitad de iteración
+# (RuntimeError). Mismo patrón que _SALT_LOCK; los get/pop sueltos no lo
+# necesitan (atómicos bajo el GIL).
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def _token_cache_key(token: str) -> str:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _cached_token_sub(token: str) -> Optional[str]:
+    entry = _TOKEN_CACHE.get(_token_cache_key(token))
+    if entry is None:
+        return None
+    sub, exp = entry
+    if exp <= time.time():
+        _TOKEN_CACHE.pop(_token_cache_key(token), None)
+        return None
+    return sub
+
+
+def _cache_token(token: str, sub: str, exp: float) -> None:
+    with _TOKEN_CACHE_LOCK:
+        if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+            now = time.time()
+            expired = [k for k, (_, e) in _TOKEN_CACHE.items() if e <= now]
+            for k in expired:
+                _TOKEN_CACHE.pop(k, None)
+            if len(_TOKEN_CACHE) >= _TOKEN_CACHE_MAX:
+                _TOKEN_CACHE.clear()
+        _TOKEN_CACHE[_token_cache_key(token)] = (sub, exp)
+
+
+def invalidate_token_cache(token: str) -> None:
+    _TOKEN_CACHE.pop(_token_cache_key(token), None)
+
+
+# User rows casi no cambian dentro de una ventana de 60s; cachear la entidad
+# (ya detached, ver expunge abajo) ahorra el SELECT por PK en cada request
+# autenticado. FastAPI ya cachea el Depends dentro de un mismo request; esto
+# cubre requests sucesivos del mismo usuario.
+_USER_CACHE: Dict[uuid.UUID, Tuple["User", float]] = {}
+_USER_CACHE_TTL = 60.0
+_USER_CACHE_MAX = 10_000
+# Mismo motivo que _TOKEN_CACHE_LOCK: el barrido de _cache_user itera el dict.
+_USER_CACHE_LOCK = threading.Lock()
+
+
+def _cached_user(user_id: uuid.UUID) -> Optional[User]:
+    entry = _USER_CACHE.get(user_id)
+    if entry is None:
+        return None
+    user, expires = entry
+    if expires <= time.time():
+        _USER_CACHE.pop(user_id, None)
+        return None
+    return user
+
+
+def _cache_user(user_id: uuid.UUID, user: User) -> None:
+    with _USER_CACHE_LOCK:
+        if len(_USER_CACHE) >= _USER_CACHE_MAX:
+            now = time.time()
+            expired = [k for k, (_, e) in _USER_CACHE.items() if e <= now]
+            for k in expired:
+                _USER_CACHE.pop(k, None)
+            if len(_USER_CACHE) >= _USER_CACHE_MAX:
+                _USER_CACHE.clear()
+        _USER_CACHE[user_id] = (user, time.time() + _USER_CACHE_TTL)
+
 
 def get_current_user(
     request: Request,
@@ -64,25 +249,50 @@ def get_current_user(
     if not token:
         _raise_invalid("Not authenticated")
 
-    try:
-        payload = decode_access_token(token)
-    except ExpiredSignatureError:
+    # Expired tokens can be rejected from the unverified exp claim alone,
+    # skipping the HMAC verify; valid-looking tokens still get a full decode.
+    exp_hint = peek_exp(token)
+    if exp_hint is not None and exp_hint < time.time():
         _raise_invalid("Token expired")
-    except JWTError:
-        _raise_invalid("Invalid token")
-    except Exception:
-        _raise_invalid("Could not validate credentials")
 
-    sub = payload.get("sub")
+    sub = _cached_token_sub(token)
     if sub is None:
-        _raise_invalid("Invalid token: missing subject")
-    try:
-        user_id = uuid.UUID(str(sub))
-    except Exception:
+        try:
+            payload = decode_access_token(token)
+        except ExpiredSignatureError:
+            _raise_invalid("Token expired")
+        except JWTError:
+            _raise_invalid("Invalid token")
+        except Exception:
+            _raise_invalid("Could not validate credentials")
+
+        sub = payload.get("sub")
+        if sub is None:
+            _raise_invalid("Invalid token: missing subject")
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            _cache_token(token, str(sub), float(exp))
+    if not isinstance(sub, str) or not _UUID_RE.match(sub):
         _raise_invalid("Invalid token: bad subject format")
+    # The GUID column type binds uuid.UUID objects, so one construction is
+    # still needed — but only after the cheap shape check has passed.
+    user_id = uuid.UUID(sub)
+
+    cached = _cached_user(user_id)
+    if cached is not None:
+        return cached
 
-    user = session.exec(select(User).where(User.id == user_id)).first()
+    # PK lookup: hits the session identity map when already loaded and reuses
+    # SQLAlchemy's cached compiled statement instead of building a new SELECT.
+    user = session.get(User, user_id)
     if user is None:
         _raise_invalid("User not found")
+    # Release the transaction immediately: this dependency only reads, and
+    # holding its snapshot (and a pooled connection) for the rest of the
+    # request starves the endpoint's own session for nothing. Expunge first
+    # so the rollback doesn't expire the instance's loaded attributes.
+    session.expunge(user)
+    session.rollback()
+    _cache_user(user_id, user)
     return user
 
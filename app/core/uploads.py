@@ -0,0 +1,47 @@
+import os
+from pathlib import Path
+
+from fastapi import HTTPException, UploadFile, status
+from fastapi.concurrency import run_in_threadpool
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10 MB
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+
+async def stream_upload_to_disk(file: UploadFile, dest: Path) -> int:
+    """Copia el upload a `dest` en bloques de 64 KB con contador de bytes.
+
+    Memoria por request: un bloque, no los 10 MB del payload completo, y el
+    kernel puede ir volcando páginas mientras el upload sigue llegando.
+    Devuelve el total escrito; si supera MAX_UPLOAD_BYTES borra el archivo
+    y corta con 400.
+
+    La escritura es write-then-rename: los bytes van a `dest.tmp`, se hace
+    un fdatasync y recién ahí os.replace() lo publica con su nombre final.
+    Si el proceso muere a mitad de la escritura, la DB nunca queda
+    apuntando a un archivo parcial.
+    """
+    tmp = dest.with_suffix(dest.suffix + ".tmp")
+    total = 0
+    out = await run_in_threadpool(open, tmp, "wb")
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(out.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            total += len(chunk)
+            if total > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Archivo demasiado grande (max 10MB)",
+                )
+            await run_in_threadpool(out.write, chunk)
+        # Un solo flush a disco al final, no uno por chunk
+        out.flush()
+        await run_in_threadpool(getattr(os, "fdatasync", os.fsync), out.fileno())
+    except BaseException:
+        await run_in_threadpool(out.close)
+        tmp.unlink(missing_ok=True)
+        raise
+    await run_in_threadpool(out.close)
+    await run_in_threadpool(os.replace, tmp, dest)
+    return total
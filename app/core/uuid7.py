@@ -0,0 +1,23 @@
+import os
+import time
+import uuid
+
+
+def uuid7() -> uuid.UUID:
+    """UUIDv7 según RFC 9562: unix-ms en los 48 bits altos, resto aleatorio.
+
+    Los IDs generados en secuencia quedan ordenados por tiempo, así que los
+    inserts caen en hojas adyacentes del B-tree en vez del patrón de página
+    aleatoria (splits + cache misses) que produce uuid4. Mismo tamaño y misma
+    API que uuid4; solo cambia la localidad de inserción.
+    """
+    ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), "big")  # 80 bits aleatorios
+    value = (
+        (ms & ((1 << 48) - 1)) << 80
+        | 0x7 << 76  # version 7
+        | (rand >> 68) << 64  # rand_a (12 bits)
+        | 0b10 << 62  # variant
+        | (rand & ((1 << 62) - 1))  # rand_b (62 bits)
+    )
+    return uuid.UUID(int=value)
@@ -1,51 +1,149 @@
 from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 from .config import settings
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
+
+
+# Echoing every statement formats all parameters and writes to stdout on the
+# hot path; keep it for local development only.
+_ECHO_SQL = settings.environment != "production"
+
+
+def _async_database_url(url: str) -> str:
+    """Map the configured URL onto its async driver (aiosqlite / asyncpg)."""
+    if "+aiosqlite" in url or "+asyncpg" in url:
+        return url
+    if url.startswith("sqlite"):
+        return url.replace("sqlite", "sqlite+aiosqlite", 1)
+    if url.startswith("postgresql"):
+        return url.replace("postgresql", "postgresql+asyncpg", 1)
+    return url
+
+
+def _configure_sqlite(sync_engine) -> None:
+    """Attach the per-connection PRAGMA / transaction hooks to an engine.
+
+    Shared between the sync engine and the async engine's underlying sync
+    engine so both pools get identically-configured connections.
+    """
+
+    # Prime every new DBAPI connection: pragmas like busy_timeout/cache_size
+    # are per-connection, so a one-shot connect would leave later pooled
+    # connections unconfigured.
+    @event.listens_for(sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_conn, connection_record):
+        # Let SQLAlchemy control transactions (see _begin below); pysqlite's
+        # implicit BEGIN-before-DML would otherwise fight with it.
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    # BEGIN IMMEDIATE acquires the write lock upfront instead of upgrading at
+    # commit: a SELECT-then-INSERT transaction (register_user, upsert_budget)
+    # waits on busy_timeout instead of failing with SQLITE_BUSY after having
+    # already done the SELECT work. But it must be scoped to write paths —
+    # emitted on every begin it made plain reads serialize behind the single
+    # write lock. Only sessions from get_write_session/get_async_write_session
+    # set the execution option; everything else opens a normal deferred read
+    # transaction (concurrent under WAL).
+    @event.listens_for(sync_engine, "begin")
+    def _begin(conn):
+        if conn.get_execution_options().get("sqlite_begin") == "IMMEDIATE":
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
 
 
 if settings.database_url.startswith("sqlite"):
+    # With WAL + busy_timeout, pooled connections are safe: readers don't block
+    # the writer and a busy writer waits instead of failing. Reusing connections
+    # avoids re-opening the database file (open/mmap/page-cache warmup) on every
+    # request, which NullPool forced us to pay.
     engine = create_engine(
         settings.database_url,
-        echo=True,
+        echo=_ECHO_SQL,
         connect_args={"check_same_thread": False, "timeout": 60},
-        poolclass=NullPool,  # avoid multiple pooled connections holding write locks
+        poolclass=QueuePool,
+        pool_size=5,
+        max_overflow=10,
+        pool_use_lifo=True,  # reuse the hottest connection first
+    )
+    _configure_sqlite(engine)
+
+    # Async twin of the engine above: the expenses router runs on the event
+    # loop with AsyncSession so DB I/O no longer pins a threadpool worker.
+    async_engine = create_async_engine(
+        _async_database_url(settings.database_url),
+        echo=_ECHO_SQL,
+        connect_args={"timeout": 60},
+        pool_size=5,
+        max_overflow=10,
     )
-    # Configure SQLite pragmas to reduce locking
-    try:
-        with engine.connect() as conn:
-            conn.exec_driver_sql("PRAGMA journal_mode=WAL;")
-            conn.exec_driver_sql("PRAGMA busy_timeout=60000;")
-    except OperationalError:
-        # If the database is momentarily locked (e.g., during reloader startup), continue without failing.
-        pass
+    _configure_sqlite(async_engine.sync_engine)
+
 else:
     engine = create_engine(
         settings.database_url,
-        echo=True,
+        echo=_ECHO_SQL,
+    )
+    async_engine = create_async_engine(
+        _async_database_url(settings.database_url),
+        echo=_ECHO_SQL,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
     )
 
 
+# "Writer" views of the engines above: same pools, but every connection
+# carries the execution option that _begin turns into BEGIN IMMEDIATE. Bound
+# at the engine so nothing runs at dependency-resolution time — the
+# transaction (and SQLite's write lock) is only taken when the handler's
+# first statement executes.
+_write_engine = engine.execution_options(sqlite_begin="IMMEDIATE")
+_async_write_engine = async_engine.execution_options(sqlite_begin="IMMEDIATE")
+
+
 def get_session():
     with Session(engine) as session:
         yield session
 
 
+def get_write_session():
+    """Session whose transactions BEGIN IMMEDIATE (SQLite write lock upfront).
+
+    Use for read-then-write endpoints (SELECT existing row, then INSERT or
+    UPDATE): a deferred transaction there could fail with SQLITE_BUSY at the
+    lock upgrade instead of waiting on busy_timeout. Write-first endpoints and
+    plain reads stay on get_session.
+    """
+    with Session(_write_engine) as session:
+        yield session
+
+
+async def get_async_session():
+    async with AsyncSession(async_engine) as session:
+        yield session
+
+
+async def get_async_write_session():
+    """Async twin of get_write_session."""
+    async with AsyncSession(_async_write_engine) as session:
+        yield session
+
+
 def init_db():
-    from .models import user, expense, budget 
-
-    # Lightweight migration for SQLite: add users.default_currency if missing.
-    try:
-        if settings.database_url.startswith("sqlite"):
-            with engine.connect() as conn:
-                cols = conn.exec_driver_sql("PRAGMA table_info('users');").fetchall()
-                col_names = {row[1] for row in cols}  # row[1] is the column name
-                if "default_currency" not in col_names:
-                    conn.exec_driver_sql(
-                        "ALTER TABLE users ADD COLUMN default_currency TEXT NOT NULL DEFAULT 'CAD'"
-                    )
-    except Exception:
-        # Best-effort migration; avoid blocking app startup if DB is locked.
-        pass
+    from .models import user, expense, budget
 
+    # Schema changes to existing tables live in scripts/migrate_*.py and run
+    # once per deployment; probing/ALTERing here made every worker contend for
+    # the write lock at startup.
     SQLModel.metadata.create_all(engine)
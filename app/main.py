@@ -1,6 +1,10 @@
 import os
+import re
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from .database import init_db
 from .routers import expenses as expenses_router
 from .routers import auth as auth_router
@@ -8,35 +12,109 @@ from .routers import receipts as receipts_router
 from .routers import budgets as budgets_router
 
 
+def _prewarm_statement_cache():
+    """Run the hot query shapes once with dummy params so their compiled SQL
+    is cached before the first real request pays the compile cost.
+
+    Only warms shapes that actually run on the sync engine (auth/budgets);
+    the expenses router lives on the async engine, whose separate cache is
+    warmed by _prewarm_async_statement_cache below.
+    """
+    import uuid
+
+    from sqlmodel import Session, select
+
+    from .database import engine
+    from .models.budget import Budget
+    from .models.user import User
+
+    nil = uuid.UUID(int=0)
+    try:
+        with Session(engine) as session:
+            session.exec(select(User).where(User.email == "")).first()
+            session.get(User, nil)
+            session.exec(
+                select(Budget).where(
+                    Budget.user_id == nil,
+                    Budget.month == "",
+                    Budget.category == "",
+                )
+            ).first()
+    except Exception:
+        # Best-effort: never block startup on pre-warming.
+        pass
+
+
+async def _prewarm_async_statement_cache():
+    """Async twin of _prewarm_statement_cache for the expenses shapes,
+    reusing the router's own query pieces so the warmed SQL can't drift
+    from what the endpoints actually execute."""
+    import uuid
+
+    from sqlmodel import select
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from .database import async_engine
+    from .models.expense import Expense
+    from .routers.expenses import _EXPENSE_LIST_COLUMNS, _get_owned_expense
+
+    nil = uuid.UUID(int=0)
+    try:
+        async with AsyncSession(async_engine) as session:
+            # Página de gastos sin cursor (list_expenses)
+            await session.exec(
+                select(*_EXPENSE_LIST_COLUMNS)
+                .where(Expense.deleted_at.is_(None))
+                .where(Expense.user_id == nil)
+                .order_by(Expense.expense_date.desc(), Expense.id.desc())
+                .limit(1)
+            )
+            # Lookup de gasto propio (get/update/delete/ocr/upload)
+            await _get_owned_expense(session, nil, nil)
+    except Exception:
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    _prewarm_statement_cache()
+    await _prewarm_async_statement_cache()
+    yield
+    # Release the worker pools (password hashing, OCR)
+    from .core.ocr import shutdown_ocr_pool
+    from .core.security import shutdown_hash_pool
+
+    shutdown_hash_pool()
+    shutdown_ocr_pool()
+
+
 def create_app() -> FastAPI:
-    app = FastAPI(title="AI Finance Manager – Backend", version="0.1.0")
-
-    # CORS origins - add production frontend URL via environment variable
-    allowed_origins = [
-        "http://localhost:5173",
-        "http://127.0.0.1:5173",
-        "http://localhost:3000",
-        "http://127.0.0.1:3000",
-        "*"  # Permitir todos para UptimeRobot
-    ]
-    
-    # Add production frontend URL if provided
+    # orjson serializa UUID/datetime/date en C; el encoder stdlib pasaba
+    # cada valor por jsonable_encoder en Python.
+    app = FastAPI(
+        title="AI Finance Manager – Backend",
+        version="0.1.0",
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
+
+    # CORS origins as a single compiled regex: Starlette matches it once per
+    # request instead of scanning a Python list. Local dev hosts are built in;
+    # the production frontend URL comes from the environment.
+    origin_patterns = [r"https?://(localhost|127\.0\.0\.1):(3000|5173)"]
     frontend_url = os.getenv("FRONTEND_URL")
     if frontend_url:
-        allowed_origins.append(frontend_url)
+        origin_patterns.append(re.escape(frontend_url.rstrip("/")))
 
     app.add_middleware(
         CORSMiddleware,
-        allow_origins=allowed_origins,
+        allow_origin_regex=f"^({'|'.join(origin_patterns)})$",
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
     )
 
-    @app.on_event("startup")
-    def on_startup():
-        init_db()
-
     @app.get("/health")
     def health():
         return {"status": "ok"}
@@ -1,20 +1,28 @@
 import uuid
 from datetime import datetime
 
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field
 
 
 class Budget(SQLModel, table=True):
     __tablename__ = "budgets"
 
+    # One budget per (user, month, category); the upsert lookup in
+    # /budgets resolves with a single B-tree descent on this index, and
+    # list_budgets' ORDER BY month/category can walk the index prefix.
+    __table_args__ = (
+        Index("ix_budgets_user_month_cat", "user_id", "month", "category", unique=True),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True, index=True)
 
-    user_id: uuid.UUID = Field(foreign_key="users.id", index=True)
+    user_id: uuid.UUID = Field(foreign_key="users.id")
 
     # YYYY-MM (e.g. 2026-02)
-    month: str = Field(index=True, min_length=7, max_length=7)
+    month: str = Field(min_length=7, max_length=7)
 
-    category: str = Field(default="OTHER", max_length=50, index=True)
+    category: str = Field(default="OTHER", max_length=50)
 
     amount: float = Field(gt=0)
     currency: str = Field(default="CAD", max_length=3)
@@ -1,17 +1,42 @@
 import uuid
 from datetime import datetime, date
 from typing import Optional
+
+from sqlalchemy import Column, ForeignKey, Index, Uuid, text
 from sqlmodel import SQLModel, Field
 
+from ..core.uuid7 import uuid7
+
 
 class Expense(SQLModel, table=True):
     __tablename__ = "expenses"
 
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True, index=True)
+    # Índice parcial solo sobre filas vivas: todos los lookups filtran
+    # user_id + deleted_at IS NULL, el listado ordena por
+    # (expense_date, id) DESC y el keyset pagina sobre ese mismo par, así
+    # que una página ya sale ordenada del índice. Excluir los tombstones
+    # lo mantiene chico aunque se acumulen soft-deletes.
+    __table_args__ = (
+        Index(
+            "ix_expenses_user_active_date",
+            "user_id",
+            text("expense_date DESC"),
+            text("id DESC"),
+            sqlite_where=text("deleted_at IS NULL"),
+            postgresql_where=text("deleted_at IS NULL"),
+        ),
+    )
+
+    # SQLAlchemy 2.x Uuid: columna `uuid` nativa en Postgres (16 bytes por
+    # entrada de índice, comparación binaria) en vez del tipo genérico de
+    # SQLModel; en SQLite sigue siendo CHAR(32), sin cambio de datos.
+    id: uuid.UUID = Field(
+        default_factory=uuid7,
+        sa_column=Column(Uuid(as_uuid=True), primary_key=True),
+    )
 
     user_id: uuid.UUID = Field(
-        foreign_key="users.id",
-        index=True
+        sa_column=Column(Uuid(as_uuid=True), ForeignKey("users.id"), nullable=False),
     )
 
     amount: float
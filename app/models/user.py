@@ -1,12 +1,20 @@
 import uuid
 from datetime import datetime
 from typing import Optional
+from sqlalchemy import Index, text
 from sqlmodel import SQLModel, Field
 
 
 class User(SQLModel, table=True):
     __tablename__ = "users"
 
+    # Case-insensitive unique lookup for login/register: the app normalizes
+    # emails to lowercase, but this keeps the index probe O(log n) even if a
+    # mixed-case variant ever reaches the query.
+    __table_args__ = (
+        Index("ix_users_email_lower", text("lower(email)"), unique=True),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True, index=True)
 
     email: str = Field(index=True, unique=True)
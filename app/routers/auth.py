@@ -1,14 +1,20 @@
 import uuid
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlmodel import SQLModel, Field, Session, select
 from pydantic import EmailStr
 
-from ..database import get_session
+from ..database import get_session, get_write_session
 from ..models.user import User
-from ..core.security import get_current_user, hash_password, verify_password
+from ..core.security import (
+    a_hash_password,
+    a_verify_password,
+    get_current_user,
+    invalidate_token_cache,
+    password_needs_rehash,
+)
 from ..core.jwt import create_access_token
 from ..config import settings
 
@@ -38,9 +44,9 @@ class UserRead(SQLModel):
     response_model=UserRead,
     status_code=status.HTTP_201_CREATED,
 )
-def register_user(
+async def register_user(
     payload: RegisterIn,
-    session: Session = Depends(get_session),
+    session: Session = Depends(get_write_session),
 ):
     if any(c.isspace() for c in payload.password):
         raise HTTPException(
@@ -48,6 +54,20 @@ def register_user(
             detail="La contraseña no debe contener espacios",
         )
     email_norm = payload.email.strip().lower()
+    currency = (payload.default_currency or "CAD").strip().upper()
+    if currency not in {"CAD", "USD", "COP"}:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid default_currency",
+        )
+
+    # Hashear antes de tocar la DB: argon2 tarda decenas de ms y la
+    # transacción de escritura (BEGIN IMMEDIATE desde el primer statement)
+    # no debe retener el write lock durante ese await. El SELECT y el INSERT
+    # quedan juntos en la misma transacción, así que el chequeo de duplicado
+    # sigue siendo atómico.
+    hashed = await a_hash_password(payload.password)
+
     exists_stmt = select(User).where(User.email == email_norm)
     existing = session.exec(exists_stmt).first()
     if existing is not None:
@@ -57,16 +77,10 @@ def register_user(
         )
 
     now = datetime.utcnow()
-    currency = (payload.default_currency or "CAD").strip().upper()
-    if currency not in {"CAD", "USD", "COP"}:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid default_currency",
-        )
     user = User(
         id=uuid.uuid4(),
         email=email_norm,
-        hashed_password=hash_password(payload.password),
+        hashed_password=hashed,
         default_currency=currency,
         created_at=now,
         updated_at=now,
@@ -76,13 +90,8 @@ def register_user(
     session.add(user)
     session.commit()
     session.refresh(user)
-    return UserRead(
-        id=user.id,
-        email=user.email,
-        default_currency=user.default_currency,
-        created_at=user.created_at,
-        updated_at=user.updated_at,
-    )
+    # response_model=UserRead filters the fields; no need to copy them by hand
+    return user
 
 
 class LoginIn(SQLModel):
@@ -100,7 +109,7 @@ class TokenOut(SQLModel):
     response_model=UserRead,
     status_code=status.HTTP_200_OK,
 )
-def login(payload: LoginIn, response: Response, session: Session = Depends(get_session)):
+async def login(payload: LoginIn, response: Response, session: Session = Depends(get_session)):
     if any(c.isspace() for c in payload.password):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -109,12 +118,25 @@ def login(payload: LoginIn, response: Response, session: Session = Depends(get_s
     email_norm = payload.email.strip().lower()
     stmt = select(User).where(User.email == email_norm)
     user = session.exec(stmt).first()
-    if user is None or not verify_password(payload.password, user.hashed_password):
+    if user is None or not await a_verify_password(payload.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password",
         )
 
+    # Migrate legacy pbkdf2 hashes to argon2 transparently on successful login.
+    # Close the read transaction first: the UPDATE then opens a fresh one whose
+    # first statement writes, so a plain BEGIN waits on busy_timeout instead of
+    # risking a failed lock upgrade mid-transaction.
+    if password_needs_rehash(user.hashed_password):
+        new_hash = await a_hash_password(payload.password)
+        session.expunge(user)
+        session.rollback()
+        user.hashed_password = new_hash
+        user.updated_at = datetime.utcnow()
+        session.add(user)
+        session.commit()
+
     # Include subject as user id and optionally email
     token = create_access_token({"sub": str(user.id), "email": user.email})
 
@@ -131,13 +153,7 @@ def login(payload: LoginIn, response: Response, session: Session = Depends(get_s
         path="/",
     )
 
-    return UserRead(
-        id=user.id,
-        email=user.email,
-        default_currency=user.default_currency,
-        created_at=user.created_at,
-        updated_at=user.updated_at,
-    )
+    return user
 
 
 @router.get(
@@ -146,20 +162,17 @@ def login(payload: LoginIn, response: Response, session: Session = Depends(get_s
     status_code=status.HTTP_200_OK,
 )
 def me(current_user: User = Depends(get_current_user)):
-    return UserRead(
-        id=current_user.id,
-        email=current_user.email,
-        default_currency=current_user.default_currency,
-        created_at=current_user.created_at,
-        updated_at=current_user.updated_at,
-    )
+    return current_user
 
 
 @router.post(
     "/logout",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-def logout(response: Response):
+def logout(request: Request, response: Response):
+    cookie_token = request.cookies.get("access_token")
+    if cookie_token:
+        invalidate_token_cache(cookie_token)
     response.delete_cookie(key="access_token", path="/")
     return None
 
@@ -169,7 +182,7 @@ def logout(response: Response):
     response_model=TokenOut,
     status_code=status.HTTP_200_OK,
 )
-def token(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = Depends(get_session)):
+async def token(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = Depends(get_session)):
     # OAuth2PasswordRequestForm usa 'username' como el campo de email
     email_norm = form_data.username.strip().lower()
     if any(c.isspace() for c in form_data.password):
@@ -178,11 +191,21 @@ def token(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = D
             detail="La contraseña no debe contener espacios",
         )
     user = session.exec(select(User).where(User.email == email_norm)).first()
-    if user is None or not verify_password(form_data.password, user.hashed_password):
+    if user is None or not await a_verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password",
         )
+    # Mismo patrón que login: soltar la transacción de lectura y dejar que el
+    # UPDATE abra una nueva que escribe de entrada.
+    if password_needs_rehash(user.hashed_password):
+        new_hash = await a_hash_password(form_data.password)
+        session.expunge(user)
+        session.rollback()
+        user.hashed_password = new_hash
+        user.updated_at = datetime.utcnow()
+        session.add(user)
+        session.commit()
     token = create_access_token({"sub": str(user.id), "email": user.email})
     return TokenOut(access_token=token, token_type="bearer")
 
@@ -5,56 +5,112 @@ from typing import List, Optional
 import os
 from pathlib import Path
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from sqlmodel import SQLModel, Field, Session, select
-from sqlalchemy.exc import OperationalError
-import time
-
-from ..database import get_session
+import base64
+import binascii
+import hashlib
+import io
+from typing import Dict
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import tuple_, update
+
+from ..core.ocr import run_ocr
+from ..core.uploads import stream_upload_to_disk
+from ..core.uuid7 import uuid7
+from ..database import get_async_session, get_async_write_session
 from ..models.expense import Expense
 from ..models.user import User
 from ..core.security import get_current_user
+from ..schemas.expense import (
+    ExpenseCreate,
+    ExpensePage,
+    ExpenseRead,
+    ExpenseUpdate,
+    OCRRead,
+)
 
 router = APIRouter(
     prefix="/expenses",
     tags=["expenses"],
 )
 
-# ─────────────────────────────
-#   SCHEMAS (Pydantic/SQLModel)
-# ─────────────────────────────
+# Resuelto una sola vez al importar: evita re-materializar la ruta (y su
+# syscall) en cada request que valida receipt_path.
+UPLOADS_ROOT = Path("uploads").resolve()
+
+# Constantes de tipo de archivo a nivel módulo: no se reconstruyen por
+# request y dejan la frontera de tipos permitidos en un solo lugar.
+ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "application/pdf"}
+_EXT_BY_CONTENT_TYPE = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "application/pdf": ".pdf",
+}
+_OCR_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+# Texto OCR por sha256 del archivo; corremos un solo proceso por instancia,
+# así que un dict in-process acotado alcanza (mismo criterio que el cache de
+# tokens en core.security).
+_OCR_CACHE: Dict[str, str] = {}
+_OCR_CACHE_MAX = 256
+
+# Columnas del listado (list_expenses); también las usa el prewarm de main
+# para calentar exactamente la misma forma de SELECT en el engine async.
+_EXPENSE_LIST_COLUMNS = (
+    Expense.id,
+    Expense.user_id,
+    Expense.amount,
+    Expense.currency,
+    Expense.description,
+    Expense.category,
+    Expense.expense_date,
+    Expense.receipt_path,
+    Expense.created_at,
+    Expense.updated_at,
+    Expense.deleted_at,
+)
 
-class ExpenseBase(SQLModel):
-    amount: float = Field(gt=0)
-    currency: str = Field(default="CAD", min_length=3, max_length=3, regex="^[A-Z]{3}$")
-    description: str = Field(min_length=1, max_length=255)
-    category: str = Field(default="OTHER", min_length=1, max_length=50)
-    expense_date: Optional[date] = Field(default=None, le=date.today())
 
+def _expense_payload(expense: Expense) -> dict:
+    """Dict serializable por orjson con las columnas expuestas en ExpenseRead."""
+    return {name: getattr(expense, name) for name in ExpenseRead.model_fields}
 
-class ExpenseCreate(ExpenseBase):
-    pass
 
+def _encode_cursor(expense_date: date, expense_id: uuid.UUID) -> str:
+    raw = f"{expense_date.isoformat()}|{expense_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
 
-class ExpenseUpdate(SQLModel):
-    amount: Optional[float] = Field(default=None, gt=0)
-    currency: Optional[str] = Field(default=None, min_length=3, max_length=3, regex="^[A-Z]{3}$")
-    description: Optional[str] = Field(default=None, min_length=1, max_length=255)
-    category: Optional[str] = Field(default=None, min_length=1, max_length=50)
-    expense_date: Optional[date] = Field(default=None, le=date.today())
 
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date_part, id_part = raw.split("|")
+        return date.fromisoformat(date_part), uuid.UUID(id_part)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
-class ExpenseRead(ExpenseBase):
-    id: uuid.UUID
-    user_id: uuid.UUID
-    receipt_path: Optional[str] = None
-    created_at: datetime
-    updated_at: datetime
-    deleted_at: Optional[datetime] = None
 
+async def _get_owned_expense(
+    session: AsyncSession,
+    expense_id: uuid.UUID,
+    user_id: uuid.UUID,
+) -> Optional[Expense]:
+    """Gasto del usuario, vivo, o None.
 
-class OCRRead(SQLModel):
-    text: str
+    Un solo WHERE indexado (id + user_id + deleted_at) en vez de un
+    session.get seguido de chequeos en Python: las filas ajenas o
+    soft-deleted nunca salen de la base.
+    """
+    statement = select(Expense).where(
+        Expense.id == expense_id,
+        Expense.user_id == user_id,
+        Expense.deleted_at.is_(None),
+    )
+    return (await session.exec(statement)).one_or_none()
 
 
 # ─────────────────────────────
@@ -66,9 +122,9 @@ class OCRRead(SQLModel):
     response_model=ExpenseRead,
     status_code=status.HTTP_201_CREATED,
 )
-def create_expense(
+async def create_expense(
     expense_in: ExpenseCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
     """
@@ -79,22 +135,30 @@ def create_expense(
     now = datetime.utcnow()
 
     expense = Expense(
-        id=uuid.uuid4(),
+        id=uuid7(),  # time-ordered PK: los inserts van a hojas contiguas del índice
         user_id=current_user.id,
         amount=expense_in.amount,
         currency=expense_in.currency,
         description=expense_in.description,
         category=expense_in.category,
-        expense_date=expense_in.expense_date or date.today(),
+        # `is None` explícito: date.today() solo se paga cuando no vino fecha
+        expense_date=(
+            expense_in.expense_date
+            if expense_in.expense_date is not None
+            else date.today()
+        ),
         created_at=now,
         updated_at=now,
         deleted_at=None,
     )
 
     session.add(expense)
-    session.commit()
-    session.refresh(expense)
-    return expense
+    # Todos los campos se fijan en Python: el refresh post-commit solo
+    # re-leería lo que ya tenemos. Armar la respuesta antes del commit
+    # (después, los atributos expiran) y ahorrarse el SELECT extra.
+    payload = _expense_payload(expense)
+    await session.commit()
+    return ORJSONResponse(payload, status_code=status.HTTP_201_CREATED)
 
 
 @router.post(
@@ -102,33 +166,39 @@ def create_expense(
     response_model=OCRRead,
     status_code=status.HTTP_200_OK,
 )
-def ocr_receipt(
+async def ocr_receipt(
     expense_id: uuid.UUID,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
-    expense = session.get(Expense, expense_id)
-    if not expense or expense.deleted_at is not None or expense.user_id != current_user.id:
+    expense = await _get_owned_expense(session, expense_id, current_user.id)
+    if expense is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
     if not expense.receipt_path:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No receipt_path set for this expense")
 
     path = Path(expense.receipt_path)
     # Restrict to uploads directory for safety
-    uploads_root = Path("uploads").resolve()
     try:
         resolved = path.resolve()
     except Exception:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid receipt_path")
-    if uploads_root not in resolved.parents and resolved != uploads_root:
+    # is_relative_to compara los componentes una vez, sin materializar la
+    # cadena completa de ancestros como hacía el scan de .parents
+    if not resolved.is_relative_to(UPLOADS_ROOT):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="receipt_path must be under uploads/")
     if not resolved.exists() or not resolved.is_file():
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt file not found")
 
     ext = resolved.suffix.lower()
-    if ext not in {".jpg", ".jpeg", ".png"}:
+    if ext not in _OCR_EXTENSIONS:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Only JPEG/PNG supported for OCR")
 
+    # Ownership y ruta ya validadas: soltar la transacción de lectura (y su
+    # conexión del pool) antes del I/O de archivo y del OCR, que pueden
+    # tardar segundos.
+    await session.rollback()
+
     try:
         # Local imports to avoid startup crash if deps not installed
         from PIL import Image
@@ -143,140 +213,215 @@ def ocr_receipt(
             detail="OCR dependencies missing. Install 'pillow' and 'pytesseract', and Tesseract OCR runtime.",
         )
 
+    # OCR es determinístico por contenido: mismo archivo → mismo texto.
+    # Con el hash de los bytes, el segundo OCR del mismo recibo es O(1).
+    data = await run_in_threadpool(resolved.read_bytes)
+    digest = hashlib.sha256(data).hexdigest()
+    cached = _OCR_CACHE.get(digest)
+    if cached is not None:
+        return OCRRead(text=cached)
+
+    def _run_ocr() -> str:
+        with Image.open(io.BytesIO(data)) as img:
+            # Escala de grises: tesseract se ahorra su propia conversión
+            return pytesseract.image_to_string(img.convert("L"))
+
     try:
-        with Image.open(resolved) as img:
-            text = pytesseract.image_to_string(img)
+        # Tesseract can take seconds on a large photo; keep it off the loop,
+        # and in the bounded OCR pool so a burst of receipts queues instead
+        # of saturating every worker thread at once.
+        text = await run_ocr(_run_ocr)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"OCR failed: {e}")
 
+    if len(_OCR_CACHE) >= _OCR_CACHE_MAX:
+        _OCR_CACHE.clear()
+    _OCR_CACHE[digest] = text
     return OCRRead(text=text)
 
 
 @router.get(
     "",
-    response_model=List[ExpenseRead],
+    response_model=ExpensePage,
 )
-def list_expenses(
-    session: Session = Depends(get_session),
+async def list_expenses(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = Query(default=None),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
     """
-    Listar gastos del usuario autenticado.
+    Listar gastos del usuario autenticado, paginados por keyset.
 
     - Siempre excluye los que tienen deleted_at (soft delete).
-    - Ordenados por fecha de gasto descendente.
+    - Ordenados por (expense_date, id) descendente.
+    - `cursor` apunta a la última fila de la página anterior: la DB hace
+      un range scan del índice y devuelve exactamente `limit` filas, sin
+      el costo O(N) de OFFSET o de cargar todo el historial.
+
+    Selecciona columnas sueltas en vez de entidades ORM: las filas no
+    pasan por el identity map y se convierten directo a ExpenseRead.
     """
-    statement = select(Expense).where(Expense.deleted_at.is_(None))
-    statement = statement.where(Expense.user_id == current_user.id)
-    statement = statement.order_by(Expense.expense_date.desc())
+    statement = (
+        select(*_EXPENSE_LIST_COLUMNS)
+        .where(Expense.deleted_at.is_(None))
+        .where(Expense.user_id == current_user.id)
+        .order_by(Expense.expense_date.desc(), Expense.id.desc())
+        .limit(limit)
+    )
+    if cursor is not None:
+        cur_date, cur_id = _decode_cursor(cursor)
+        statement = statement.where(
+            tuple_(Expense.expense_date, Expense.id) < (cur_date, cur_id)
+        )
 
-    expenses = session.exec(statement).all()
-    return expenses
+    rows = (await session.exec(statement)).all()
+    # Filas → dicts → orjson, sin pasar por pydantic: los valores ya vienen
+    # tipados de la DB y orjson serializa UUID/date/datetime nativamente.
+    # Devolver una Response salta la re-validación del response_model (que
+    # queda solo como documentación OpenAPI).
+    items = [dict(row._mapping) for row in rows]
+    next_cursor = None
+    if len(items) == limit:
+        last = items[-1]
+        next_cursor = _encode_cursor(last["expense_date"], last["id"])
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
 
 
 @router.get(
     "/{expense_id}",
     response_model=ExpenseRead,
 )
-def get_expense(
+async def get_expense(
     expense_id: uuid.UUID,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
     """Obtener un gasto por ID del usuario autenticado (si no está soft-deleted)."""
-    expense = session.get(Expense, expense_id)
+    expense = await _get_owned_expense(session, expense_id, current_user.id)
 
-    if not expense or expense.deleted_at is not None or expense.user_id != current_user.id:
+    if expense is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Expense not found",
         )
 
-    return expense
+    # Datos confiables (vienen de la DB): serializar directo con orjson en
+    # vez de re-validarlos a través del response_model.
+    return ORJSONResponse(_expense_payload(expense))
 
 
 @router.patch(
     "/{expense_id}",
     response_model=ExpenseRead,
 )
-def update_expense(
+async def update_expense(
     expense_id: uuid.UUID,
     expense_in: ExpenseUpdate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
-    """Actualizar parcialmente un gasto del usuario autenticado."""
-    expense = session.get(Expense, expense_id)
+    """Actualizar parcialmente un gasto del usuario autenticado.
 
-    if not expense or expense.deleted_at is not None or expense.user_id != current_user.id:
+    Un solo UPDATE ... RETURNING con los campos enviados: sin el SELECT
+    previo ni el dirty tracking campo-a-campo del ORM, y la fila
+    actualizada vuelve en el mismo round-trip.
+    """
+    data = expense_in.model_dump(exclude_unset=True, exclude_none=True)
+    if not data:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Expense not found",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No fields to update",
+        )
+
+    stmt = (
+        update(Expense)
+        .where(
+            Expense.id == expense_id,
+            Expense.user_id == current_user.id,
+            Expense.deleted_at.is_(None),
         )
+        .values(**data, updated_at=datetime.utcnow())
+        .returning(Expense)
+    )
+    expense = (await session.execute(stmt)).scalar_one_or_none()
 
-    updated = False
-
-    if expense_in.amount is not None:
-        expense.amount = expense_in.amount
-        updated = True
-    if expense_in.currency is not None:
-        expense.currency = expense_in.currency
-        updated = True
-    if expense_in.description is not None:
-        expense.description = expense_in.description
-        updated = True
-    if expense_in.category is not None:
-        expense.category = expense_in.category
-        updated = True
-    if expense_in.expense_date is not None:
-        expense.expense_date = expense_in.expense_date
-        updated = True
-
-    if updated:
-        expense.updated_at = datetime.utcnow()
-        session.add(expense)
-        session.commit()
-        session.refresh(expense)
-    else:
+    if expense is None:
+        await session.rollback()
         raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="No fields to update",
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Expense not found",
         )
 
-    return expense
+    # Armar la respuesta antes del commit: después, los atributos expiran.
+    payload = _expense_payload(expense)
+    await session.commit()
+    return ORJSONResponse(payload)
 
 
 @router.delete(
     "/{expense_id}",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-def delete_expense(
+async def delete_expense(
     expense_id: uuid.UUID,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_write_session),
     current_user: User = Depends(get_current_user),
 ):
     """
     Soft delete del gasto del usuario autenticado:
     - En vez de borrar el registro, marca deleted_at.
     """
-    expense = session.get(Expense, expense_id)
+    expense = await _get_owned_expense(session, expense_id, current_user.id)
 
-    if not expense or expense.deleted_at is not None or expense.user_id != current_user.id:
+    if expense is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Expense not found",
         )
 
-    expense.deleted_at = datetime.utcnow()
-    expense.updated_at = datetime.utcnow()
+    now = datetime.utcnow()
+    expense.deleted_at = expense.updated_at = now
 
     session.add(expense)
-    session.commit()
+    await session.commit()
     return
 
 
-MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10 MB
-ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "application/pdf"}
+@router.post(
+    "/bulk_delete",
+    status_code=status.HTTP_200_OK,
+)
+async def bulk_delete_expenses(
+    ids: List[uuid.UUID],
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user),
+):
+    """Soft delete en lote de gastos del usuario autenticado.
+
+    Un solo UPDATE ... WHERE id IN (...) y un solo commit (un fsync) para
+    N ids, en vez de N DELETEs individuales pagando un fsync cada uno.
+    Ids ajenos, inexistentes o ya borrados simplemente no matchean.
+    """
+    if not ids:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No ids provided",
+        )
+
+    now = datetime.utcnow()
+    stmt = (
+        update(Expense)
+        .where(
+            Expense.id.in_(ids),
+            Expense.user_id == current_user.id,
+            Expense.deleted_at.is_(None),
+        )
+        .values(deleted_at=now, updated_at=now)
+    )
+    result = await session.execute(stmt)
+    await session.commit()
+    return {"deleted": result.rowcount}
 
 
 @router.post(
@@ -284,10 +429,10 @@ ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "application/pdf"}
     response_model=ExpenseRead,
     status_code=status.HTTP_200_OK,
 )
-def upload_receipt(
+async def upload_receipt(
     expense_id: uuid.UUID,
     file: UploadFile = File(...),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     current_user: User = Depends(get_current_user),
 ):
     """Sube un recibo (imagen/pdf) para un gasto y guarda la ruta local.
@@ -296,8 +441,8 @@ def upload_receipt(
     - Tamaño máximo: 10 MB.
     - Ruta: uploads/{user_id}/{expense_id}_{uuid}.{ext}
     """
-    expense = session.get(Expense, expense_id)
-    if not expense or expense.deleted_at is not None or expense.user_id != current_user.id:
+    expense = await _get_owned_expense(session, expense_id, current_user.id)
+    if expense is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Expense not found for user {current_user.id}; expense_id={expense_id}",
@@ -308,19 +453,8 @@ def upload_receipt(
     if content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tipo de archivo no permitido")
 
-    # Leer contenido con límite
-    data = file.file.read(MAX_UPLOAD_BYTES + 1)
-    if len(data) == 0:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo vacío")
-    if len(data) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo demasiado grande (max 10MB)")
-
     # Determinar extensión por content-type
-    ext = {
-        "image/jpeg": ".jpg",
-        "image/png": ".png",
-        "application/pdf": ".pdf",
-    }.get(content_type, "")
+    ext = _EXT_BY_CONTENT_TYPE.get(content_type, "")
 
     # Carpeta destino
     base_dir = Path("uploads") / str(current_user.id)
@@ -329,25 +463,37 @@ def upload_receipt(
     filename = f"{expense_id}_{uuid.uuid4().hex}{ext}"
     save_path = base_dir / filename
 
-    with open(save_path, "wb") as f:
-        f.write(data)
-
-    # Guardar ruta relativa
-    expense.receipt_path = str(save_path.as_posix())
-    expense.updated_at = datetime.utcnow()
-    # Try committing with small retries to avoid transient SQLite locks
-    for attempt in range(3):
-        try:
-            session.add(expense)
-            session.commit()
-            session.refresh(expense)
-            break
-        except OperationalError:
-            session.rollback()
-            if attempt == 2:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Database is busy, please retry",
-                )
-            time.sleep(0.25 * (attempt + 1))
-    return expense
+    # El stream avanza al ritmo del cliente (hasta 10 MB): soltar la
+    # transacción de lectura antes de empezar para no retener el snapshot
+    # ni una conexión del pool mientras tanto.
+    await session.rollback()
+
+    # Copia incremental a disco con límite de tamaño
+    total = await stream_upload_to_disk(file, save_path)
+    if total == 0:
+        save_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo vacío")
+
+    # Guardar ruta relativa en una transacción corta que escribe de entrada
+    # (mismo UPDATE ... RETURNING que update_expense); con WAL + busy_timeout
+    # un writer ocupado espera en vez de fallar con SQLITE_BUSY.
+    stmt = (
+        update(Expense)
+        .where(
+            Expense.id == expense_id,
+            Expense.user_id == current_user.id,
+            Expense.deleted_at.is_(None),
+        )
+        .values(receipt_path=str(save_path.as_posix()), updated_at=datetime.utcnow())
+        .returning(Expense)
+    )
+    expense = (await session.execute(stmt)).scalar_one_or_none()
+    if expense is None:
+        # El gasto desapareció mientras subíamos (borrado concurrente)
+        await session.rollback()
+        save_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+
+    payload = _expense_payload(expense)
+    await session.commit()
+    return ORJSONResponse(payload)
@@ -1,49 +1,171 @@
+import base64
+import functools
+import hashlib
+import json
+import logging
 import os
 import re
-import time
+import threading
 import uuid
 from datetime import date, datetime
 from pathlib import Path
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
-from sqlalchemy.exc import OperationalError
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import insert
 from sqlmodel import Field, Session, SQLModel
 
 from ..core.security import get_current_user
+from ..core.uploads import stream_upload_to_disk
+from ..core.uuid7 import uuid7
 from ..database import get_session
 from ..models.expense import Expense
 from ..models.user import User
+from ..schemas.expense import Currency, ExpenseRead
 
 router = APIRouter(
     prefix="/receipts",
     tags=["receipts"],
 )
 
-MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10 MB
+logger = logging.getLogger(__name__)
+
+# Dependencias opcionales resueltas una sola vez al importar el módulo: los
+# handlers chequean el flag en vez de repetir try/import por request, y una
+# instalación rota se ve en el log de arranque. La falla sigue siendo un 503
+# por endpoint, no un crash del proceso.
+try:
+    import cv2
+    import pytesseract
+
+    _OCR_OK = True
+    _OCR_ERR = ""
+except Exception as _e:
+    _OCR_OK = False
+    _OCR_ERR = str(_e)
+
+# tesserocr bindea libtesseract in-process: sin fork/exec del binario
+# tesseract ni recarga de traineddata por llamada (pytesseract paga ambos en
+# cada image_to_string). Dependencia opcional: si no está, el fallback sigue
+# siendo pytesseract. El handle de la API no es thread-safe, así que todo
+# acceso va detrás de _TESS_LOCK.
+try:
+    import tesserocr
+    from PIL import Image as _PILImage
+
+    _TESSEROCR_OK = True
+except Exception:
+    _TESSEROCR_OK = False
+
+_TESS_APIS: dict = {}
+_TESS_LOCK = threading.Lock()
+
+
+def _tesserocr_text(pil_image, lang: str) -> str:
+    """OCR con el handle persistente de libtesseract (uno por idioma)."""
+    with _TESS_LOCK:
+        api = _TESS_APIS.get(lang)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang=lang, psm=tesserocr.PSM.SINGLE_BLOCK)
+            _TESS_APIS[lang] = api
+        try:
+            api.SetImage(pil_image)
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+
+try:
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_openai import ChatOpenAI
+
+    _LLM_OK = True
+except Exception:
+    _LLM_OK = False
+
+
+# Un cliente por modelo y por proceso: ChatOpenAI arrastra su pool de
+# conexiones HTTP, así que reconstruirlo por request tiraba el keep-alive
+# y pagaba TCP/TLS de nuevo en cada recibo. lru_cache en vez de un global
+# para no instanciar nada al importar si falta la API key.
+@functools.lru_cache(maxsize=4)
+def _get_llm(model: str) -> "ChatOpenAI":
+    return ChatOpenAI(
+        model=model,
+        temperature=0,
+        api_key=os.getenv("OPENAI_API_KEY"),
+    )
+
+
+# Prompts estáticos compilados una vez al importar (from_messages parsea el
+# template; no hace falta repetirlo por llamada).
+if _LLM_OK:
+    _PARSE_PROMPT = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "You extract expenses from OCR text of a purchase receipt.",
+            ),
+            (
+                "human",
+                "OCR TEXT:\n{ocr_text}\n\n"
+                "Extract all line-item expenses (including taxes/tips if explicitly listed). "
+                "Rules: amount must be a positive number; currency must be 3-letter uppercase if present else CAD; "
+                "category should be one of: FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER; "
+                "expense_date must be YYYY-MM-DD if present else null. "
+                "If you cannot find any expenses, return an empty list of items.",
+            ),
+        ]
+    )
+
+    _VISION_PROMPT = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You extract expenses from receipt images."),
+            (
+                "human",
+                [
+                    {"type": "text", "text": "Extract all line-item expenses from this receipt image. Rules: amount must be a positive number; currency must be 3-letter uppercase if present else CAD; category should be one of: FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER; expense_date must be YYYY-MM-DD if present else null. If you cannot find any expenses, return an empty list of items."},
+                    {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{image_b64}"}},
+                ],
+            ),
+        ]
+    )
+
+    _CLASSIFY_PROMPT = ChatPromptTemplate.from_messages(
+        [
+            (
+                "system",
+                "You classify expense descriptions into one of these categories: "
+                "FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER.",
+            ),
+            (
+                "human",
+                "Assign a category to each of these expense descriptions. "
+                "Descriptions: {descriptions_json}",
+            ),
+        ]
+    )
+
 ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png"}
 
+# Resuelta una sola vez al importar (mismo criterio que UPLOADS_ROOT en el
+# router de gastos): la validación por request queda puramente en memoria.
+_UPLOADS_ROOT = Path("uploads").resolve()
+_ALLOWED_CATEGORIES = frozenset(
+    {"FOOD", "GROCERIES", "TRANSPORT", "ENTERTAINMENT", "HEALTH", "UTILITIES", "RENT", "OTHER"}
+)
+
 
 class ReceiptExpenseItem(SQLModel):
     amount: float = Field(gt=0)
-    currency: str = Field(default="CAD", min_length=3, max_length=3, regex="^[A-Z]{3}$")
+    currency: Currency = Field(default="CAD")
     description: str = Field(min_length=1, max_length=255)
     category: str = Field(default="OTHER", min_length=1, max_length=50)
     expense_date: Optional[date] = Field(default=None, le=date.today())
 
 
-class ExpenseRead(SQLModel):
-    id: uuid.UUID
-    user_id: uuid.UUID
-    amount: float
-    currency: str
-    description: str
-    category: str
-    expense_date: date
-    receipt_path: Optional[str] = None
-    created_at: datetime
-    updated_at: datetime
-    deleted_at: Optional[datetime] = None
+# ExpenseRead vive en app.schemas.expense, compartido con el router de
+# gastos: una sola clase compilada por proceso.
 
 
 class ReceiptProcessOut(SQLModel):
@@ -54,7 +176,7 @@ class ReceiptProcessOut(SQLModel):
 
 class ReceiptConfirmItem(SQLModel):
     amount: float = Field(gt=0)
-    currency: str = Field(default="CAD", min_length=3, max_length=3, regex="^[A-Z]{3}$")
+    currency: Currency = Field(default="CAD")
     description: str = Field(min_length=1, max_length=255)
     category: str = Field(default="OTHER", min_length=1, max_length=50)
     expense_date: Optional[date] = Field(default=None)
@@ -70,15 +192,49 @@ class ReceiptConfirmOut(SQLModel):
     expenses_created: List[ExpenseRead]
 
 
+# Esquemas para with_structured_output: el modelo emite JSON válido contra
+# el schema (function calling) y langchain lo parsea directo a pydantic, sin
+# json.loads sobre el string crudo ni validación a mano de lista/objeto.
+class ParsedReceipt(SQLModel):
+    items: List[ReceiptExpenseItem] = Field(default_factory=list)
+
+
+class CategoryLabel(SQLModel):
+    description: str
+    category: str
+
+
+class ClassifiedDescriptions(SQLModel):
+    labels: List[CategoryLabel] = Field(default_factory=list)
+
+
+# Cache exacto in-process para las llamadas LLM: mismo texto/imagen/lote de
+# descripciones → misma respuesta, así que un hit se resuelve en sub-ms sin
+# tocar OpenAI. Un proceso por instancia (mismo criterio que los caches de
+# core.security), dict acotado con reset simple al llenarse. El tier
+# semántico por embeddings quedó afuera: sumaría una dependencia vectorial
+# y una llamada de embedding por miss para un backend con poco tráfico.
+_LLM_CACHE_MAX = 256
+_PARSE_TEXT_CACHE: dict = {}
+_PARSE_IMAGE_CACHE: dict = {}
+_CLASSIFY_CACHE: dict = {}
+
+
+def _norm_description(s: str) -> str:
+    return " ".join((s or "").strip().split()).casefold()
+
+
+def _llm_cache_put(cache: dict, key: str, value) -> None:
+    if len(cache) >= _LLM_CACHE_MAX:
+        cache.clear()
+    cache[key] = value
+
+
 def _ocr_image(image_path: Path) -> str:
-    try:
-        import pytesseract
-        import cv2
-        import numpy as np
-    except ImportError as e:
+    if not _OCR_OK:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail=f"OCR dependencies missing: {str(e)}. Install 'pytesseract' and 'opencv-python', and Tesseract OCR runtime.",
+            detail=f"OCR dependencies missing: {_OCR_ERR}. Install 'pytesseract' and 'opencv-python', and Tesseract OCR runtime.",
         )
 
     tess_cmd = os.getenv("TESSERACT_CMD")
@@ -86,18 +242,21 @@ def _ocr_image(image_path: Path) -> str:
         pytesseract.pytesseract.tesseract_cmd = tess_cmd
 
     try:
-        img = cv2.imread(str(image_path))
-        if img is None:
+        # Decodificar directo a un canal: evita el cvtColor sobre el BGR
+        # completo (3x los bytes) y el resize trabaja ya sobre el buffer chico.
+        gray = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt file not found")
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
         h, w = gray.shape[:2]
-        scale = 2.0 if max(h, w) < 2000 else 1.0
-        if scale != 1.0:
-            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+        if max(h, w) < 2000:
+            # Para tesseract el upscale es solo densidad de pixeles; lineal
+            # alcanza y cuesta bastante menos que cúbico.
+            gray = cv2.resize(gray, None, fx=2.0, fy=2.0, interpolation=cv2.INTER_LINEAR)
 
-        gray = cv2.GaussianBlur(gray, (3, 3), 0)
+        # dst=gray: blur y umbral reescriben el mismo buffer uint8 en vez de
+        # materializar un ndarray nuevo por paso (~4MB c/u a 2000px).
+        cv2.GaussianBlur(gray, (3, 3), 0, dst=gray)
 
         thresh = cv2.adaptiveThreshold(
             gray,
@@ -106,38 +265,88 @@ def _ocr_image(image_path: Path) -> str:
             cv2.THRESH_BINARY,
             31,
             10,
+            dst=gray,
         )
 
-        coords = np.column_stack(np.where(thresh < 255))
-        if coords.size > 0:
+        # El ángulo de sesgo es invariante a escala: detectarlo sobre un
+        # thumbnail a 0.25x recorre ~16x menos puntos en minAreaRect y el
+        # warp igual se aplica a resolución completa.
+        small = cv2.resize(thresh, (0, 0), fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+        # findNonZero entrega los pixeles de texto como Nx1x2 int32 listo
+        # para minAreaRect; np.where + column_stack armaba un N×2 int64
+        # intermedio por cada pixel oscuro.
+        coords = cv2.findNonZero(cv2.bitwise_not(small))
+        if coords is not None:
             angle = cv2.minAreaRect(coords)[-1]
             if angle < -45:
                 angle = -(90 + angle)
             else:
                 angle = -angle
 
-            (hh, ww) = thresh.shape[:2]
-            M = cv2.getRotationMatrix2D((ww // 2, hh // 2), angle, 1.0)
-            thresh = cv2.warpAffine(
-                thresh,
-                M,
-                (ww, hh),
-                flags=cv2.INTER_CUBIC,
-                borderMode=cv2.BORDER_REPLICATE,
-            )
+            # Bajo medio grado tesseract no mejora: saltearse el warp entero
+            if abs(angle) >= 0.5:
+                (hh, ww) = thresh.shape[:2]
+                M = cv2.getRotationMatrix2D((ww // 2, hh // 2), angle, 1.0)
+                thresh = cv2.warpAffine(
+                    thresh,
+                    M,
+                    (ww, hh),
+                    flags=cv2.INTER_CUBIC,
+                    borderMode=cv2.BORDER_REPLICATE,
+                )
 
-        config = "--oem 3 --psm 6"
-        try:
-            return pytesseract.image_to_string(thresh, lang="spa+eng", config=config)
-        except pytesseract.TesseractError:
-            return pytesseract.image_to_string(thresh, lang="eng", config=config)
+        def _run_ocr(lang: str) -> str:
+            if _TESSEROCR_OK:
+                return _tesserocr_text(_PILImage.fromarray(thresh), lang)
+            return pytesseract.image_to_string(thresh, lang=lang, config="--oem 3 --psm 6")
+
+        # OCR_LANG pinea el idioma (p.ej. "spa+eng" para un deployment con
+        # recibos locales) y se saltea la heurística.
+        forced_lang = os.getenv("OCR_LANG")
+        if forced_lang:
+            return _run_ocr(forced_lang)
+
+        # Primera pasada solo en inglés: cargar el LSTM de español duplica el
+        # tiempo de modelo y la mayoría de los recibos salen limpios sin él.
+        # Si el texto trae >5% de caracteres no-ASCII (acentos, ñ — señal de
+        # que el recibo no era inglés puro), re-correr con spa+eng.
+        text = _run_ocr("eng")
+        if text and sum(ch > "\x7f" for ch in text) > 0.05 * len(text):
+            try:
+                text = _run_ocr("spa+eng")
+            except (RuntimeError, pytesseract.TesseractError):
+                # Sin el traineddata de español: quedarse con la pasada eng
+                pass
+        return text
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"OCR failed: {e}")
 
 
-def _parse_receipt_with_llm(ocr_text: str) -> List[ReceiptExpenseItem]:
+def _condense_ocr(text: str) -> str:
+    """Compacta el dump OCR antes de mandarlo al modelo.
+
+    Tira líneas vacías y líneas sin ningún dígito (logos, direcciones,
+    separadores decorativos — los renglones con montos siempre traen
+    dígitos) y colapsa el whitespace interno. Menos tokens de entrada =
+    menos latencia y costo por recibo; el ocr_text crudo sigue viajando
+    en la respuesta para debugging del cliente.
+    """
+    lines = (_WS_RE.sub(" ", ln).strip() for ln in text.splitlines())
+    return "\n".join(ln for ln in lines if ln and any(ch.isdigit() for ch in ln))
+
+
+async def _parse_receipt_with_llm(ocr_text: str) -> List[ReceiptExpenseItem]:
+    ocr_text = _condense_ocr(ocr_text)
+    # Clave por hash del texto condensado: el mismo recibo re-procesado no
+    # paga una segunda llamada, incluso si el ruido OCR alrededor varió.
+    cache_key = hashlib.sha256(ocr_text.encode("utf-8")).hexdigest()
+    cached = _PARSE_TEXT_CACHE.get(cache_key)
+    if cached is not None:
+        # Copias: los callers pueden mutar los items sin tocar el cache
+        return [item.model_copy() for item in cached]
+
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(
@@ -145,76 +354,37 @@ def _parse_receipt_with_llm(ocr_text: str) -> List[ReceiptExpenseItem]:
             detail="Missing OPENAI_API_KEY",
         )
 
-    try:
-        from langchain_openai import ChatOpenAI
-        from langchain_core.prompts import ChatPromptTemplate
-    except Exception:
+    if not _LLM_OK:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="LLM dependencies missing. Install 'langchain' and 'langchain-openai'.",
         )
 
-    import json
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You extract expenses from OCR text of a purchase receipt. "
-                "Return only valid JSON. Do not include markdown.",
-            ),
-            (
-                "human",
-                "OCR TEXT:\n{ocr_text}\n\n"
-                "Extract all line-item expenses (including taxes/tips if explicitly listed). "
-                "Output ONLY a JSON array ([]) of objects with fields: amount, currency, description, category, expense_date. "
-                "Rules: amount must be a positive number; currency must be 3-letter uppercase if present else CAD; "
-                "category should be one of: FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER; "
-                "expense_date must be YYYY-MM-DD if present else null. "
-                "If you cannot find any expenses, return an empty JSON array [].",
-            ),
-        ]
-    )
-
-    llm = ChatOpenAI(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
-        temperature=0,
-        api_key=api_key,
-    )
+    # with_structured_output: el schema viaja como function call y langchain
+    # devuelve el pydantic ya validado — sin json.loads del string crudo ni
+    # chequeos a mano de lista/objeto (que antes terminaban en 500 por drift).
+    llm = _get_llm(os.getenv("OPENAI_MODEL", "gpt-4o-mini")).with_structured_output(ParsedReceipt)
 
     try:
-        result = llm.invoke(prompt.format_messages(ocr_text=ocr_text))
+        # ainvoke: la espera de red no bloquea el event loop
+        result = await llm.ainvoke(_PARSE_PROMPT.format_messages(ocr_text=ocr_text))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"LLM call failed: {e}")
 
-    content = getattr(result, "content", None)
-    if not content or not isinstance(content, str):
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="LLM returned empty response")
-
-    try:
-        data = json.loads(content)
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to parse LLM output: {e}")
-
-    if data is None:
+    if result is None:
         return []
 
-    if isinstance(data, dict):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="LLM output must be a JSON array, got object",
-        )
-    if not isinstance(data, list):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="LLM output must be a JSON array",
-        )
-
-    items = [ReceiptExpenseItem(**x) for x in data]
-
-    return items
+    items = list(result.items)
+    # El prompt ya pide una categoría del set permitido; si el modelo
+    # inventa otra, colapsa a OTHER acá mismo (sin segunda llamada).
+    for item in items:
+        if item.category not in _ALLOWED_CATEGORIES:
+            item.category = "OTHER"
+    _llm_cache_put(_PARSE_TEXT_CACHE, cache_key, items)
+    return [item.model_copy() for item in items]
 
 
-def _parse_receipt_with_llm_from_image(image_path: Path) -> List[ReceiptExpenseItem]:
+async def _parse_receipt_with_llm_from_image(image_path: Path) -> List[ReceiptExpenseItem]:
     """Use vision model to extract items directly from image (no OCR)."""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
@@ -223,70 +393,69 @@ def _parse_receipt_with_llm_from_image(image_path: Path) -> List[ReceiptExpenseI
             detail="Missing OPENAI_API_KEY",
         )
 
-    try:
-        import base64
-        from langchain_openai import ChatOpenAI
-        from langchain_core.prompts import ChatPromptTemplate
-    except Exception:
+    if not _LLM_OK:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="LLM dependencies missing. Install 'langchain' and 'langchain-openai'.",
         )
 
-    # Read and encode image
-    with open(image_path, "rb") as f:
-        image_data = f.read()
-    image_b64 = base64.b64encode(image_data).decode()
+    # Read and encode image (lectura de disco fuera del event loop)
+    image_data = await run_in_threadpool(image_path.read_bytes)
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You extract expenses from receipt images. Return only valid JSON. Do not include markdown."),
-        ("human", [
-            {"type": "text", "text": "Extract all line-item expenses from this receipt image. Output ONLY a JSON array ([]) of objects with fields: amount, currency, description, category, expense_date. Rules: amount must be a positive number; currency must be 3-letter uppercase if present else CAD; category should be one of: FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER; expense_date must be YYYY-MM-DD if present else null. If you cannot find any expenses, return an empty JSON array []"},
-            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}}
-        ])
-    ])
+    # Mismos bytes de imagen → mismos items: hit directo sin llamada de visión
+    cache_key = hashlib.sha256(image_data).hexdigest()
+    cached = _PARSE_IMAGE_CACHE.get(cache_key)
+    if cached is not None:
+        return [item.model_copy() for item in cached]
 
-    llm = ChatOpenAI(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o"),
-        temperature=0,
-        api_key=api_key,
-    )
-
-    try:
-        result = llm.invoke(prompt.format_messages())
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"LLM call failed: {e}")
+    image_b64 = base64.b64encode(image_data).decode()
 
-    content = getattr(result, "content", None)
-    if not content or not isinstance(content, str):
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="LLM returned empty response")
+    llm = _get_llm(os.getenv("OPENAI_MODEL", "gpt-4o")).with_structured_output(ParsedReceipt)
 
     try:
-        import json
-        data = json.loads(content)
+        result = await llm.ainvoke(_VISION_PROMPT.format_messages(image_b64=image_b64))
     except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to parse LLM output: {e}")
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"LLM call failed: {e}")
 
-    if data is None:
+    if result is None:
         return []
 
-    if isinstance(data, dict):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="LLM output must be a JSON array, got object",
-        )
-    if not isinstance(data, list):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="LLM output must be a JSON array",
-        )
+    items = list(result.items)
+    for item in items:
+        if item.category not in _ALLOWED_CATEGORIES:
+            item.category = "OTHER"
+    _llm_cache_put(_PARSE_IMAGE_CACHE, cache_key, items)
+    return [item.model_copy() for item in items]
+
+
+# Patrones del parser local compilados una vez al importar, no por llamada
+# (re.compile dentro de la funci\u00f3n pagaba sre_compile/lookup en cada recibo).
+_AMOUNT_LAST_RE = re.compile(r"^\s*(?P<desc>.+?)\s+\$?(?P<amt>\d{1,6}[\,\.]\d{2})\s*$")
+_TRAILING_QTY_RE = re.compile(r"\s*(?:x|\u00d7)\s*\d{1,3}\s*$", re.IGNORECASE)
+_RECEIPT_LINE_RE = re.compile(
+    r"\b(\d+)\s+([A-Za-z0-9\-\_ ]{3,}?)\s*(\d{1,4})\s*[\,\.\s]\s*(\d{2})\b"
+)
+_AMOUNT_LAST_ANY_RE = re.compile(
+    r"^\s*(?P<desc>(?=.*[A-Za-z\u00c0-\u00ff]).+?)\s+\$?(?P<amt>\d{1,6}[\,\.]\d{2})\s*$"
+)
+_NBSP_TRANS = str.maketrans({"\u00a0": " "})
+_WS_RE = re.compile(r"\s+")
+
+# RE2 (DFA de tiempo lineal) para el \u00fanico patr\u00f3n que hace finditer sobre el
+# dump OCR completo: el quantifier perezoso {3,}? es backtracking cl\u00e1sico y
+# en texto OCR largo puede degenerar. Los otros patrones matchean l\u00ednea por
+# l\u00ednea (entrada corta) y _AMOUNT_LAST_ANY_RE usa lookahead, que RE2 no
+# soporta. Dependencia opcional: sin re2 queda el patr\u00f3n stdlib de arriba.
+try:
+    import re2 as _re2
 
-    items = [ReceiptExpenseItem(**x) for x in data]
-    return items
+    _RECEIPT_LINE_RE = _re2.compile(_RECEIPT_LINE_RE.pattern)
+except ImportError:
+    pass
 
 
 def _parse_receipt_locally(ocr_text: str) -> List[ReceiptExpenseItem]:
-    text = ocr_text.replace("\u00a0", " ")
+    text = ocr_text.translate(_NBSP_TRANS)
 
     def _norm_line(s: str) -> str:
         return " ".join((s or "").strip().split())
@@ -303,19 +472,16 @@ def _parse_receipt_locally(ocr_text: str) -> List[ReceiptExpenseItem]:
         return v
 
     def _type1_amount_at_end(full_text: str) -> List[ReceiptExpenseItem]:
-        amount_last = re.compile(r"^\s*(?P<desc>.+?)\s+\$?(?P<amt>\d{1,6}[\,\.]\d{2})\s*$")
-        trailing_qty = re.compile(r"\s*(?:x|×)\s*\d{1,3}\s*$", re.IGNORECASE)
-
         out: List[ReceiptExpenseItem] = []
         for raw_line in full_text.splitlines():
             line = _norm_line(raw_line)
             if not line:
                 continue
-            m = amount_last.match(line)
+            m = _AMOUNT_LAST_RE.match(line)
             if not m:
                 continue
             desc = _norm_line(m.group("desc") or "")
-            desc = trailing_qty.sub("", desc).strip()
+            desc = _TRAILING_QTY_RE.sub("", desc).strip()
             amount = _to_amount(m.group("amt") or "")
             if not desc or amount is None:
                 continue
@@ -331,12 +497,8 @@ def _parse_receipt_locally(ocr_text: str) -> List[ReceiptExpenseItem]:
         return out
 
     def _type2_qty_first_global(full_text: str) -> List[ReceiptExpenseItem]:
-        pattern = re.compile(
-            r"\b(\d+)\s+([A-Za-z0-9\-\_ ]{3,}?)\s*(\d{1,4})\s*[\,\.\s]\s*(\d{2})\b"
-        )
-
         out: List[ReceiptExpenseItem] = []
-        for match in pattern.finditer(full_text):
+        for match in _RECEIPT_LINE_RE.finditer(full_text):
             _qty_s, desc_raw, amount_int_s, amount_dec_s = match.groups()
             desc = " ".join(desc_raw.strip().split())
             if not desc:
@@ -359,16 +521,12 @@ def _parse_receipt_locally(ocr_text: str) -> List[ReceiptExpenseItem]:
         return out
 
     def _fallback_conservative(full_text: str) -> List[ReceiptExpenseItem]:
-        amount_last_any = re.compile(
-            r"^\s*(?P<desc>(?=.*[A-Za-zÀ-ÿ]).+?)\s+\$?(?P<amt>\d{1,6}[\,\.]\d{2})\s*$"
-        )
-
         out: List[ReceiptExpenseItem] = []
         for raw_line in full_text.splitlines():
             line = _norm_line(raw_line)
             if not line:
                 continue
-            m = amount_last_any.match(line)
+            m = _AMOUNT_LAST_ANY_RE.match(line)
             if not m:
                 continue
             desc = _norm_line(m.group("desc") or "")
@@ -398,7 +556,7 @@ def _parse_receipt_locally(ocr_text: str) -> List[ReceiptExpenseItem]:
     return combined
 
 
-def _classify_categories(descriptions: List[str]) -> dict:
+async def _classify_categories(descriptions: List[str]) -> dict:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(
@@ -409,66 +567,51 @@ def _classify_categories(descriptions: List[str]) -> dict:
     if not descriptions:
         return {}
 
-    unique = list(dict.fromkeys(descriptions))
+    # "COCA COLA" y "Coca Cola" son la misma descripción para el modelo:
+    # dedupe por forma normalizada (espacios colapsados + casefold) y un solo
+    # representante por grupo viaja en el prompt; la categoría se propaga de
+    # vuelta a cada original al final.
+    norm_to_orig: dict = {}
+    for d in descriptions:
+        norm_to_orig.setdefault(_norm_description(d), d)
+    unique = list(norm_to_orig.values())
+
+    def _broadcast(by_norm: dict) -> dict:
+        out = {}
+        for d in descriptions:
+            cat = by_norm.get(_norm_description(d))
+            if cat is not None:
+                out[d] = cat
+        return out
 
-    try:
-        from langchain_openai import ChatOpenAI
-        from langchain_core.prompts import ChatPromptTemplate
-    except Exception:
+    # El orden no afecta el mapeo: clave por hash de las normalizadas ordenadas
+    cache_key = hashlib.sha256("\x00".join(sorted(norm_to_orig)).encode("utf-8")).hexdigest()
+    cached = _CLASSIFY_CACHE.get(cache_key)
+    if cached is not None:
+        return _broadcast(cached)
+
+    if not _LLM_OK:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="LLM dependencies missing. Install 'langchain' and 'langchain-openai'.",
         )
 
-    import json
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You classify expense descriptions into one of these categories: "
-                "FOOD, GROCERIES, TRANSPORT, ENTERTAINMENT, HEALTH, UTILITIES, RENT, OTHER. "
-                "Return only valid JSON. Do not include markdown.",
-            ),
-            (
-                "human",
-                "Given these expense descriptions, return a JSON object mapping each description to a category. "
-                "Descriptions: {descriptions_json}",
-            ),
-        ]
-    )
-
-    llm = ChatOpenAI(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
-        temperature=0,
-        api_key=api_key,
-    )
+    llm = _get_llm(os.getenv("OPENAI_MODEL", "gpt-4o-mini")).with_structured_output(ClassifiedDescriptions)
 
     try:
-        result = llm.invoke(
-            prompt.format_messages(descriptions_json=json.dumps(unique, ensure_ascii=False))
+        result = await llm.ainvoke(
+            _CLASSIFY_PROMPT.format_messages(descriptions_json=json.dumps(unique, ensure_ascii=False))
         )
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"LLM call failed: {e}")
 
-    content = getattr(result, "content", None)
-    if not content or not isinstance(content, str):
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="LLM returned empty response")
-
-    try:
-        data = json.loads(content)
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to parse LLM output: {e}")
-
-    if not isinstance(data, dict):
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="LLM output must be a JSON object")
-
-    allowed = {"FOOD", "GROCERIES", "TRANSPORT", "ENTERTAINMENT", "HEALTH", "UTILITIES", "RENT", "OTHER"}
-    out = {}
-    for k, v in data.items():
-        if isinstance(k, str) and isinstance(v, str) and v in allowed:
-            out[k] = v
-    return out
+    by_norm = {}
+    if result is not None:
+        for label in result.labels:
+            if label.category in _ALLOWED_CATEGORIES:
+                by_norm[_norm_description(label.description)] = label.category
+    _llm_cache_put(_CLASSIFY_CACHE, cache_key, by_norm)
+    return _broadcast(by_norm)
 
 
 @router.post(
@@ -476,7 +619,7 @@ def _classify_categories(descriptions: List[str]) -> dict:
     response_model=ReceiptProcessOut,
     status_code=status.HTTP_201_CREATED,
 )
-def process_receipt(
+async def process_receipt(
     file: UploadFile = File(...),
     session: Session = Depends(get_session),
     current_user: User = Depends(get_current_user),
@@ -485,12 +628,6 @@ def process_receipt(
     if content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Tipo de archivo no permitido")
 
-    data = file.file.read(MAX_UPLOAD_BYTES + 1)
-    if len(data) == 0:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo vacío")
-    if len(data) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo demasiado grande (max 10MB)")
-
     ext = {
         "image/jpeg": ".jpg",
         "image/png": ".png",
@@ -501,37 +638,47 @@ def process_receipt(
 
     filename = f"receipt_{uuid.uuid4().hex}{ext}"
     save_path = base_dir / filename
-    with open(save_path, "wb") as f:
-        f.write(data)
+    # Copia incremental a disco con límite de tamaño (un bloque de 64 KB en
+    # memoria por request, no los 10 MB del payload completo)
+    total = await stream_upload_to_disk(file, save_path)
+    if total == 0:
+        save_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Archivo vacío")
 
     receipt_path = str(save_path.as_posix())
 
     # TODO: Replace OCR with vision model
-    # ocr_text = _ocr_image(save_path)
-    # try:
+    # ocr_text = await run_ocr(_ocr_image, save_path)  # pool acotado de core.ocr
+    # if logger.isEnabledFor(logging.DEBUG):
     #     ocr_lines = [ln for ln in (ocr_text or "").splitlines() if ln.strip()]
-    #     print("=== DEBUG: OCR TEXT STATS ===")
-    #     print(f"ocr_len={len(ocr_text or '')} nonempty_lines={len(ocr_lines)}")
-    #     preview = (ocr_text or "").replace("\r", "")[:600]
-    #     print("ocr_preview_start=\n" + preview)
-    #     print("=== DEBUG: OCR TEXT STATS END ===")
-    # except Exception as e:
-    #     print(f"=== DEBUG: OCR TEXT STATS FAILED: {e} ===")
+    #     logger.debug(
+    #         "OCR stats: ocr_len=%d nonempty_lines=%d preview=%s",
+    #         len(ocr_text or ""), len(ocr_lines),
+    #         (ocr_text or "").replace("\r", "")[:600],
+    #     )
 
+    # Si algún día volvemos al parser local (sin categorías del modelo),
+    # ahí sí: una sola pasada de _classify_categories sobre descripciones
+    # deduplicadas.
     # items = _parse_receipt_locally(ocr_text)
-    items = _parse_receipt_with_llm_from_image(save_path)
-    print(f"=== DEBUG: PARSED ITEMS COUNT: {len(items)} ===")
-    category_map = _classify_categories([i.description for i in items])
-    for item in items:
-        item.category = category_map.get(item.description, "OTHER")
-
-    # DEBUG: Log parsed expenses without saving
-    print("=== DEBUG: Parsed expenses from LLM ===")
-    for i, item in enumerate(items, 1):
-        print(f"{i}. amount={item.amount} currency={item.currency} description={item.description} category={item.category} expense_date={item.expense_date}")
-    print("=========================================")
+    # category_map = await _classify_categories([i.description for i in items])
+
+    # El parser con visión ya devuelve category validada contra el set
+    # permitido: re-clasificar era un segundo round-trip a OpenAI sobre
+    # las mismas descripciones.
+    items = await _parse_receipt_with_llm_from_image(save_path)
+    # Guardado con isEnabledFor: en prod ni el loop ni el formateo corren
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Parsed %d items from LLM", len(items))
+        for i, item in enumerate(items, 1):
+            logger.debug(
+                "%d. amount=%s currency=%s description=%s category=%s expense_date=%s",
+                i, item.amount, item.currency, item.description, item.category, item.expense_date,
+            )
 
     now = datetime.utcnow()
+    # today una sola vez, como now: no repetir la llamada por item
+    today = date.today()
     preview_out = [
         ExpenseRead(
             id=uuid.uuid4(),
@@ -540,7 +687,7 @@ def process_receipt(
             currency=item.currency,
             description=item.description,
             category=item.category,
-            expense_date=item.expense_date or date.today(),
+            expense_date=item.expense_date or today,
             receipt_path=receipt_path,
             created_at=now,
             updated_at=now,
@@ -549,61 +696,10 @@ def process_receipt(
         for item in items
     ]
 
-    # TODO: Uncomment to save to DB
-    # now = datetime.utcnow()
-    # created: List[Expense] = []
-    #
-    # for item in items:
-    #     expense = Expense(
-    #         id=uuid.uuid4(),
-    #         user_id=current_user.id,
-    #         amount=item.amount,
-    #         currency=item.currency,
-    #         description=item.description,
-    #         category=item.category,
-    #         expense_date=item.expense_date or date.today(),
-    #         receipt_path=receipt_path,
-    #         created_at=now,
-    #         updated_at=now,
-    #         deleted_at=None,
-    #     )
-    #     session.add(expense)
-    #     created.append(expense)
-    #
-    # for attempt in range(3):
-    #     try:
-    #         session.commit()
-    #         break
-    #     except OperationalError:
-    #         session.rollback()
-    #         if attempt == 2:
-    #             raise HTTPException(
-    #                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-    #                 detail="Database is busy, please retry",
-    #             )
-    #         time.sleep(0.25 * (attempt + 1))
-    #
-    # for exp in created:
-    #     session.refresh(exp)
-    #
-    # created_out = [
-    #     ExpenseRead(
-    #         id=exp.id,
-    #         user_id=exp.user_id,
-    #         amount=exp.amount,
-    #         currency=exp.currency,
-    #         description=exp.description,
-    #         category=exp.category,
-    #         expense_date=exp.expense_date,
-    #         receipt_path=exp.receipt_path,
-    #         created_at=exp.created_at,
-    #         updated_at=exp.updated_at,
-    #         deleted_at=exp.deleted_at,
-    #     )
-    #     for exp in created
-    # ]
-    #
-    # return ReceiptProcessOut(receipt_path=receipt_path, ocr_text=ocr_text, expenses_created=created_out)
+    # Si este endpoint vuelve a persistir en vez de solo previsualizar,
+    # copiar el patrón de confirm_receipt: un insert(Expense) multi-fila con
+    # ids uuid7 y timestamps pre-generados, y la respuesta armada desde esos
+    # mismos dicts — nada de session.add por item ni refresh post-commit.
 
     return ReceiptProcessOut(receipt_path=receipt_path, ocr_text="", expenses_preview=preview_out)
 
@@ -619,77 +715,60 @@ def confirm_receipt(
     current_user: User = Depends(get_current_user),
 ):
     path = Path(payload.receipt_path)
-    uploads_root = Path("uploads").resolve()
     try:
         resolved = path.resolve()
     except Exception:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid receipt_path")
-    if uploads_root not in resolved.parents and resolved != uploads_root:
+    # is_relative_to compara componentes en memoria: nada de armar la lista
+    # de .parents ni re-resolver uploads/ por request.
+    if not resolved.is_relative_to(_UPLOADS_ROOT):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="receipt_path must be under uploads/")
 
-    user_dir = (Path("uploads") / str(current_user.id)).resolve()
-    if user_dir not in resolved.parents:
+    if not resolved.is_relative_to(_UPLOADS_ROOT / str(current_user.id)):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="receipt_path does not belong to current user")
 
     if not resolved.exists() or not resolved.is_file():
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Receipt file not found")
 
     now = datetime.utcnow()
-    created: List[Expense] = []
+    today = date.today()
+    receipt_path = str(path.as_posix())
+
+    logger.debug("/receipts/confirm: received %d expenses", len(payload.expenses))
 
-    print(f"=== DEBUG /receipts/confirm ===")
-    print(f"Received {len(payload.expenses)} expenses")
-    
+    # Un solo INSERT multi-fila en vez de N adds por el identity map del ORM.
+    # Los ids van pre-generados (uuid7, igual que el default del modelo), así
+    # que la respuesta sale de estos mismos dicts sin refresh ni SELECTs
+    # post-commit.
+    rows = []
     for idx, item in enumerate(payload.expenses, 1):
-        final_date = item.expense_date or date.today()
-        print(f"Expense {idx}: received_date={item.expense_date}, final_date={final_date}, desc={item.description}")
-        
-        expense = Expense(
-            id=uuid.uuid4(),
-            user_id=current_user.id,
-            amount=item.amount,
-            currency=item.currency,
-            description=item.description,
-            category=item.category,
-            expense_date=final_date,
-            receipt_path=str(path.as_posix()),
-            created_at=now,
-            updated_at=now,
-            deleted_at=None,
+        final_date = item.expense_date or today
+        logger.debug(
+            "Expense %d: received_date=%s final_date=%s desc=%s",
+            idx, item.expense_date, final_date, item.description,
+        )
+        rows.append(
+            {
+                "id": uuid7(),
+                "user_id": current_user.id,
+                "amount": item.amount,
+                "currency": item.currency,
+                "description": item.description,
+                "category": item.category,
+                "expense_date": final_date,
+                "receipt_path": receipt_path,
+                "created_at": now,
+                "updated_at": now,
+                "deleted_at": None,
+            }
         )
-        session.add(expense)
-        created.append(expense)
-    
-    print(f"================================")
 
-    for attempt in range(3):
-        try:
-            session.commit()
-            break
-        except OperationalError:
-            session.rollback()
-            if attempt == 2:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="Database is busy, please retry",
-                )
-            time.sleep(0.25 * (attempt + 1))
+    # Con WAL + busy_timeout + BEGIN IMMEDIATE en el engine, un writer
+    # ocupado espera en vez de fallar con SQLITE_BUSY: el viejo loop de
+    # retry con sleep ya no tiene qué atrapar.
+    session.execute(insert(Expense), rows)
+    session.commit()
 
-    created_out = [
-        ExpenseRead(
-            id=exp.id,
-            user_id=exp.user_id,
-            amount=exp.amount,
-            currency=exp.currency,
-            description=exp.description,
-            category=exp.category,
-            expense_date=exp.expense_date,
-            receipt_path=exp.receipt_path,
-            created_at=exp.created_at,
-            updated_at=exp.updated_at,
-            deleted_at=exp.deleted_at,
-        )
-        for exp in created
-    ]
+    created_out = [ExpenseRead(**row) for row in rows]
 
-    return ReceiptConfirmOut(receipt_path=str(path.as_posix()), expenses_created=created_out)
+    return ReceiptConfirmOut(receipt_path=receipt_path, expenses_created=created_out)
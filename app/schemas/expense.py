@@ -0,0 +1,82 @@
+"""Schemas de gastos compartidos entre routers.
+
+Cada clase pydantic construye (y retiene) su validador/serializador
+compilado, así que los schemas viven acá una sola vez y los routers los
+importan, en vez de duplicar definiciones por archivo.
+"""
+import re
+import uuid
+from datetime import date, datetime
+from typing import Annotated, List, Optional
+
+from pydantic import AfterValidator
+from sqlmodel import Field, SQLModel
+
+# Un solo patrón compilado compartido por todos los campos currency;
+# declarar regex= en cada Field haría que pydantic compile (y retenga)
+# una copia del patrón por campo.
+_CURRENCY_RE = re.compile(r"^[A-Z]{3}$")
+
+
+def _validate_currency(value: str) -> str:
+    if not _CURRENCY_RE.fullmatch(value):
+        raise ValueError("currency must be a 3-letter uppercase code")
+    return value
+
+
+Currency = Annotated[str, AfterValidator(_validate_currency)]
+
+
+def _validate_not_future(value: Optional[date]) -> Optional[date]:
+    # date.today() al validar, no al declarar: un bound le=date.today() en el
+    # Field se evalúa una sola vez al importar y queda congelado, así que
+    # pasada la medianoche rechazaría hasta el propio "hoy".
+    if value is not None and value > date.today():
+        raise ValueError("expense_date cannot be in the future")
+    return value
+
+
+PastOrTodayDate = Annotated[Optional[date], AfterValidator(_validate_not_future)]
+
+
+class ExpenseBase(SQLModel):
+    amount: float = Field(gt=0)
+    currency: Currency = Field(default="CAD")
+    description: str = Field(min_length=1, max_length=255)
+    category: str = Field(default="OTHER", min_length=1, max_length=50)
+    expense_date: PastOrTodayDate = Field(default=None)
+
+
+class ExpenseCreate(ExpenseBase):
+    pass
+
+
+class ExpenseUpdate(SQLModel):
+    amount: Optional[float] = Field(default=None, gt=0)
+    currency: Optional[Currency] = Field(default=None)
+    description: Optional[str] = Field(default=None, min_length=1, max_length=255)
+    category: Optional[str] = Field(default=None, min_length=1, max_length=50)
+    expense_date: PastOrTodayDate = Field(default=None)
+
+
+class ExpenseRead(ExpenseBase):
+    id: uuid.UUID
+    user_id: uuid.UUID
+    receipt_path: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    deleted_at: Optional[datetime] = None
+
+    # Modelo de lectura: las fechas vienen de la DB, no del cliente, y los
+    # recibos aceptan items con fecha futura a propósito — sin el bound
+    # heredado de ExpenseBase.
+    expense_date: Optional[date] = None
+
+
+class ExpensePage(SQLModel):
+    items: List[ExpenseRead]
+    next_cursor: Optional[str] = None
+
+
+class OCRRead(SQLModel):
+    text: str
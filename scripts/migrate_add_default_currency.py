@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+# Ensure project backend root is on sys.path
+BACKEND_ROOT = Path(__file__).resolve().parents[1]
+if str(BACKEND_ROOT) not in sys.path:
+    sys.path.insert(0, str(BACKEND_ROOT))
+
+from app.database import engine
+from app.config import settings
+from sqlmodel import text
+
+
+def column_exists_sqlite(conn, table: str, column: str) -> bool:
+    result = conn.exec_driver_sql(f"PRAGMA table_info('{table}')")
+    for _cid, name, _type, _notnull, _dflt, _pk in result.fetchall():
+        if name == column:
+            return True
+    return False
+
+
+def main():
+    url = settings.database_url or ""
+    print(f"Database URL: {url}")
+    with engine.connect() as conn:
+        if url.startswith("sqlite"):
+            if column_exists_sqlite(conn, "users", "default_currency"):
+                print("Column 'default_currency' already exists on 'users'. Nothing to do.")
+                return
+            print("Adding column 'default_currency' to 'users' (SQLite)...")
+            conn.exec_driver_sql(
+                "ALTER TABLE users ADD COLUMN default_currency TEXT NOT NULL DEFAULT 'CAD'"
+            )
+            conn.commit()
+            print("Done.")
+        else:
+            # Generic SQL for Postgres-like engines
+            print("Adding column 'default_currency' to 'users' (non-SQLite)...")
+            conn.execute(text("""
+                ALTER TABLE IF EXISTS users
+                ADD COLUMN IF NOT EXISTS default_currency TEXT NOT NULL DEFAULT 'CAD'
+            """))
+            conn.commit()
+            print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+# Ensure project backend root is on sys.path
+BACKEND_ROOT = Path(__file__).resolve().parents[1]
+if str(BACKEND_ROOT) not in sys.path:
+    sys.path.insert(0, str(BACKEND_ROOT))
+
+from app.database import engine
+from app.config import settings
+from sqlmodel import text
+
+# Índices declarados en los modelos después del primer deploy. create_all
+# salta las tablas que ya existen, así que en una DB vieja estos índices
+# nunca se crean solos; este script los crea una vez (IF NOT EXISTS lo hace
+# idempotente). La sintaxis vale igual en SQLite y Postgres.
+INDEXES = [
+    # Lookup de login case-insensitive + unicidad de email (ver models/user.py)
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))",
+    # Listado de gastos activos por usuario, en el orden del keyset pagination
+    "CREATE INDEX IF NOT EXISTS ix_expenses_user_active_date "
+    "ON expenses (user_id, expense_date DESC, id DESC) WHERE deleted_at IS NULL",
+    # Upsert de presupuesto por (user, month, category) + unicidad
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_budgets_user_month_cat "
+    "ON budgets (user_id, month, category)",
+]
+
+
+def main():
+    url = settings.database_url or ""
+    print(f"Database URL: {url}")
+    with engine.connect() as conn:
+        for stmt in INDEXES:
+            name = stmt.split(" IF NOT EXISTS ", 1)[1].split(" ", 1)[0]
+            print(f"Ensuring index '{name}'...")
+            conn.execute(text(stmt))
+        conn.commit()
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
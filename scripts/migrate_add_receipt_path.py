@@ -12,11 +12,21 @@ from sqlmodel import text
 
 
 def column_exists_sqlite(conn, table: str, column: str) -> bool:
-    result = conn.exec_driver_sql(f"PRAGMA table_info('{table}')")
-    for _cid, name, _type, _notnull, _dflt, _pk in result.fetchall():
-        if name == column:
-            return True
-    return False
+    # pragma_table_info como tabla (SQLite >= 3.16): el filtro corre en el
+    # engine y vuelve a lo sumo una fila, sin iterar todas las columnas en
+    # Python. En SQLite viejo cae al PRAGMA clásico.
+    try:
+        row = conn.exec_driver_sql(
+            "SELECT 1 FROM pragma_table_info(?) WHERE name = ? LIMIT 1",
+            (table, column),
+        ).fetchone()
+        return row is not None
+    except Exception:
+        result = conn.exec_driver_sql(f"PRAGMA table_info('{table}')")
+        for _cid, name, _type, _notnull, _dflt, _pk in result.fetchall():
+            if name == column:
+                return True
+        return False
 
 
 def main():